@@ -8,11 +8,14 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import atexit
 import json
 import logging
 import os
+import threading
 import time
 import uuid
+import weakref
 from importlib.metadata import version
 
 import requests
@@ -24,6 +27,12 @@ except ImportError:
 
 from tqdm import tqdm
 
+from . import dataset, diskspace
+from .constraints import ConstraintsCache
+from .request import encode, toJSON
+from .transform import get_transform
+from .transport import TransportError, get_transport
+
 
 def bytes_to_string(n):
     u = ["", "K", "M", "G", "T", "P"]
@@ -74,21 +83,134 @@ def get_url_key_verify(url, key, verify):
     return url, key, verify
 
 
-def toJSON(obj):
-    to_json = getattr(obj, "toJSON", None)
-    if callable(to_json):
-        return to_json()
+_CLEANERS = weakref.WeakSet()
 
-    if isinstance(obj, (list, tuple)):
-        return [toJSON(x) for x in obj]
 
-    if isinstance(obj, dict):
-        r = {}
-        for k, v in obj.items():
-            r[k] = toJSON(v)
-        return r
+@atexit.register
+def _close_cleaners():
+    for cleaner in list(_CLEANERS):
+        cleaner.close(timeout=cleaner.exit_timeout)
+
+
+class Cleaner(object):
+    """Delete finished tasks on the server from a background thread.
+
+    Request ids are queued with ``add()`` and deleted in batches by a daemon
+    worker, so that task deletion never blocks a retrieve or runs from the
+    garbage collector. Ids queued twice are coalesced, failed deletions are
+    retried up to ``retry_max`` times. ``flush()`` waits for the queue to
+    drain and ``close()`` also stops the worker once the queue is empty; it is
+    restarted on the next ``add()``. There is never more than one worker.
+    """
+
+    def __init__(self, client, retry_max=3, sleep=1, exit_timeout=10):
+        self.url = client.url
+        self.transport = client.transport
+        self.timeout = client.timeout
+
+        self.debug = client.debug
+        self.warning = client.warning
+
+        self.retry_max = retry_max
+        self.sleep = sleep
+        self.exit_timeout = exit_timeout
+
+        self._pending = {}
+        self._busy = 0
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+        _CLEANERS.add(self)
+
+    def add(self, request_id):
+        with self._cond:
+            self._pending.setdefault(request_id, 0)
+            # A closing worker still owns the queue and keeps serving it
+            self._closed = False
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="cdsapi-cleaner", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _delete(self, request_id):
+        task_url = "%s/tasks/%s" % (self.url, request_id)
+        self.debug("DELETE %s", task_url)
+        try:
+            delete = self.transport.delete(task_url, timeout=self.timeout)
+        except Exception as e:
+            self.debug("DELETE %s failed: %s", task_url, e)
+            return False
+
+        self.debug("DELETE returns %s %s", delete.status_code, delete.reason)
+        if delete.status_code == 404:
+            return True
+        try:
+            delete.raise_for_status()
+        except Exception:
+            self.debug(
+                "DELETE %s returns %s %s", task_url, delete.status_code, delete.reason
+            )
+            return False
+        return True
 
-    return obj
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    # Give up ownership under the lock, so that add() starts
+                    # a new worker only once this one is gone
+                    self._thread = None
+                    return
+                batch = self._pending
+                self._pending = {}
+                self._busy = len(batch)
+
+            failed = {}
+            for request_id, tries in batch.items():
+                if not self._delete(request_id):
+                    tries += 1
+                    if tries < self.retry_max:
+                        failed[request_id] = tries
+                    else:
+                        self.warning("Could not delete task %s", request_id)
+
+            with self._cond:
+                for request_id, tries in failed.items():
+                    self._pending.setdefault(request_id, tries)
+                self._busy = 0
+                self._cond.notify_all()
+
+            if failed:
+                time.sleep(self.sleep)
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending) + self._busy
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        done = self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None and done:
+            thread.join(timeout)
+        return done
 
 
 class Result(object):
@@ -97,10 +219,11 @@ class Result(object):
 
         self._url = client.url
 
-        self.session = client.session
+        self.transport = client.transport
         self.robust = client.robust
         self.verify = client.verify
         self.cleanup = client.delete
+        self.cleaner = client.cleaner
 
         self.debug = client.debug
         self.info = client.info
@@ -111,6 +234,10 @@ class Result(object):
 
         self.timeout = client.timeout
         self.progress = client.progress
+        self.disk_space = client.disk_space
+
+        # Path(s) of the last download, which may have been spilled elsewhere
+        self.target = None
 
         self._deleted = False
 
@@ -123,26 +250,54 @@ class Result(object):
         )
         return r
 
-    def _download(self, url, size, target):
+    def _download(self, url, size, target, transform=None):
         if target is None:
             target = url.split("/")[-1]
 
+        transform = get_transform(transform)
+        if transform is not None:
+            transform.start()
+        # Transforms such as the GRIB splitter write their own files instead
+        output = transform is None or transform.output
+
+        reservation = None
+        try:
+            # Fail before the transfer rather than on a full disk half way through
+            if self.disk_space is not None and output:
+                reservation = self.disk_space.reserve(target, size)
+                if reservation.target != target:
+                    self.warning(
+                        "Not enough space for %s, spilling to %s",
+                        target,
+                        reservation.target,
+                    )
+                    target = reservation.target
+
+            target = self._transfer(url, size, target, transform, reservation)
+            return target if output else list(transform.paths)
+        finally:
+            if transform is not None:
+                transform.close()
+            if reservation is not None:
+                reservation.release()
+
+    def _transfer(self, url, size, target, transform, reservation=None):
         self.info("Downloading %s to %s (%s)", url, target, bytes_to_string(size))
         start = time.time()
 
+        output = target
+        if transform is not None and not transform.output:
+            output = os.devnull
+
         mode = "wb"
         total = 0
         sleep = 10
         tries = 0
-        headers = None
+        offset = 0
 
         while tries < self.retry_max:
-            r = self.robust(self.session.get)(
-                url,
-                stream=True,
-                verify=self.verify,
-                headers=headers,
-                timeout=self.timeout,
+            r = self.robust(self.transport.stream)(
+                url, start=offset, timeout=self.timeout
             )
             try:
                 r.raise_for_status()
@@ -156,14 +311,19 @@ class Result(object):
                     leave=False,
                 ) as pbar:
                     pbar.update(total)
-                    with open(target, mode) as f:
+                    with open(output, mode) as f:
                         for chunk in r.iter_content(chunk_size=1024):
                             if chunk:
-                                f.write(chunk)
+                                if transform is None:
+                                    f.write(chunk)
+                                else:
+                                    transform.write(f, chunk)
                                 total += len(chunk)
                                 pbar.update(len(chunk))
+                                if reservation is not None:
+                                    reservation.update(total)
 
-            except requests.exceptions.ConnectionError as e:
+            except (requests.exceptions.ConnectionError, TransportError) as e:
                 self.error("Download interupted: %s" % (e,))
             finally:
                 r.close()
@@ -177,11 +337,13 @@ class Result(object):
             self.warning("Sleeping %s seconds" % (sleep,))
             time.sleep(sleep)
             mode = "ab"
-            total = os.path.getsize(target)
+            # The transform output size is unrelated to the bytes received
+            if transform is None:
+                total = os.path.getsize(target)
             sleep *= 1.5
             if sleep > self.sleep_max:
                 sleep = self.sleep_max
-            headers = {"Range": "bytes=%d-" % total}
+            offset = total
             tries += 1
             self.warning("Resuming download at byte %s" % (total,))
 
@@ -190,14 +352,29 @@ class Result(object):
                 "Download failed: downloaded %s byte(s) out of %s" % (total, size)
             )
 
+        if transform is not None:
+            with open(output, "ab") as f:
+                transform.finish(f)
+
         elapsed = time.time() - start
         if elapsed:
             self.info("Download rate %s/s", bytes_to_string(size / elapsed))
 
         return target
 
-    def download(self, target=None):
-        return self._download(self.location, self.content_length, target)
+    def download(self, target=None, transform=None):
+        """Download the result and return the path actually written.
+
+        With a transform writing its own files, return the list of their paths.
+        """
+        self.target = self._download(
+            self.location, self.content_length, target, transform
+        )
+        return self.target
+
+    def to_xarray(self, cache_dir=None, **kwargs):
+        """Download the result to the cache and open it lazily with xarray."""
+        return dataset.result_to_xarray(self, cache_dir, **kwargs)
 
     @property
     def content_length(self):
@@ -220,9 +397,7 @@ class Result(object):
 
     def check(self):
         self.debug("HEAD %s", self.location)
-        metadata = self.robust(self.session.head)(
-            self.location, verify=self.verify, timeout=self.timeout
-        )
+        metadata = self.robust(self.transport.head)(self.location, timeout=self.timeout)
         metadata.raise_for_status()
         self.debug(metadata.headers)
         return metadata
@@ -233,9 +408,7 @@ class Result(object):
         task_url = "%s/tasks/%s" % (self._url, request_id)
         self.debug("GET %s", task_url)
 
-        result = self.robust(self.session.get)(
-            task_url, verify=self.verify, timeout=self.timeout
-        )
+        result = self.robust(self.transport.get)(task_url, timeout=self.timeout)
         result.raise_for_status()
         self.reply = result.json()
 
@@ -249,9 +422,7 @@ class Result(object):
             task_url = "%s/tasks/%s" % (self._url, rid)
             self.debug("DELETE %s", task_url)
 
-            delete = self.session.delete(
-                task_url, verify=self.verify, timeout=self.timeout
-            )
+            delete = self.transport.delete(task_url, timeout=self.timeout)
             self.debug("DELETE returns %s %s", delete.status_code, delete.reason)
 
             try:
@@ -267,11 +438,14 @@ class Result(object):
             self._deleted = True
 
     def __del__(self):
+        # Never talk to the server from the garbage collector: hand the task
+        # over to the client's background cleaner instead
         try:
-            if self.cleanup:
-                self.delete()
-        except Exception as e:
-            print(e)
+            if self.cleanup and not self._deleted and "request_id" in self.reply:
+                self.cleaner.add(self.reply["request_id"])
+                self._deleted = True
+        except Exception:
+            pass
 
 
 class Client(object):
@@ -307,6 +481,11 @@ class Client(object):
         metadata=None,
         forget=False,
         session=requests.Session(),
+        validate=False,
+        constraints_dir=None,
+        constraints_ttl=24 * 3600,
+        disk_space=diskspace.DEFAULT,
+        transport=None,
     ):
         if not quiet:
             if debug:
@@ -345,20 +524,32 @@ class Client(object):
         self.info_callback = info_callback
         self.error_callback = error_callback
 
-        self.session = session
-        self.session.auth = tuple(self.key.split(":", 2))
-        self.session.headers = {
-            "User-Agent": f"cdsapi/{version('cdsapi')}",
-        }
-
-        assert len(self.session.auth) == 2, (
+        auth = tuple(self.key.split(":", 2))
+        assert len(auth) == 2, (
             "The cdsapi key provided is not the correct format, please ensure it conforms to:\n"
             "<UID>:<APIKEY>"
         )
 
+        self.session = session
+        self.transport = get_transport(
+            transport,
+            auth=auth,
+            headers={"User-Agent": f"cdsapi/{version('cdsapi')}"},
+            verify=self.verify,
+            session=session,
+        )
+
         self.metadata = metadata
         self.forget = forget
 
+        self.cleaner = Cleaner(self)
+        self.disk_space = disk_space
+
+        self.validate = validate
+        self.constraints = ConstraintsCache(
+            self, cache_dir=constraints_dir, ttl=constraints_ttl
+        )
+
         self.debug(
             "CDSAPI %s",
             dict(
@@ -374,15 +565,32 @@ class Client(object):
                 delete=self.delete,
                 metadata=self.metadata,
                 forget=self.forget,
+                validate=self.validate,
             ),
         )
 
-    def retrieve(self, name, request, target=None):
+    def close(self, timeout=None):
+        """Wait for queued task deletions to complete."""
+        return self.cleaner.close(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def retrieve(self, name, request, target=None, transform=None):
+        if self.validate:
+            request = self.constraints.validate(name, toJSON(request))
         result = self._api("%s/resources/%s" % (self.url, name), request, "POST")
         if target is not None:
-            result.download(target)
+            result.download(target, transform=transform)
         return result
 
+    def retrieve_dataset(self, name, request, cache_dir=None, **kwargs):
+        """Retrieve ``request`` unless cached and open it lazily with xarray."""
+        return dataset.retrieve_dataset(self, name, request, cache_dir, **kwargs)
+
     def service(self, name, *args, **kwargs):
         self.delete = False  # Don't delete results
         name = "/".join(name.split("."))
@@ -395,7 +603,6 @@ class Client(object):
 
         if self.metadata:
             request["_cds_metadata"] = self.metadata
-        request = toJSON(request)
         result = self._api(
             "%s/tasks/services/%s/clientid-%s" % (self.url, name, uuid.uuid4().hex),
             request,
@@ -410,7 +617,7 @@ class Client(object):
 
     def status(self, context=None):
         url = "%s/status.json" % (self.url,)
-        r = self.session.get(url, verify=self.verify, timeout=self.timeout)
+        r = self.transport.get(url, timeout=self.timeout)
         r.raise_for_status()
         return r.json()
 
@@ -434,20 +641,28 @@ class Client(object):
             pass
 
     def _api(self, url, request, method):
+        reply = self._submit(url, request, method)
+
+        if self.forget:
+            return reply
+
+        if not self.wait_until_complete:
+            return Result(self, reply)
+
+        return self._wait(reply)
+
+    def _submit(self, url, request, method):
         self._status(url)
 
-        session = self.session
+        # Encode once, the same body is reused if the request is retried
+        body = encode(request)
 
         self.info("Sending request to %s", url)
-        self.debug("%s %s %s", method, url, json.dumps(request))
-
-        if method == "PUT":
-            action = session.put
-        else:
-            action = session.post
+        if self.debug_callback or self.logger.isEnabledFor(logging.DEBUG):
+            self.debug("%s %s %s", method, url, body)
 
-        result = self.robust(action)(
-            url, json=request, verify=self.verify, timeout=self.timeout
+        result = self.robust(self.transport.submit)(
+            method, url, body, timeout=self.timeout
         )
 
         if self.forget:
@@ -482,9 +697,9 @@ class Client(object):
             else:
                 raise
 
-        if not self.wait_until_complete:
-            return Result(self, reply)
+        return reply
 
+    def _wait(self, reply):
         sleep = 1
 
         while True:
@@ -514,9 +729,7 @@ class Client(object):
                 task_url = "%s/tasks/%s" % (self.url, rid)
                 self.debug("GET %s", task_url)
 
-                result = self.robust(session.get)(
-                    task_url, verify=self.verify, timeout=self.timeout
-                )
+                result = self.robust(self.transport.get)(task_url, timeout=self.timeout)
                 result.raise_for_status()
                 reply = result.json()
                 continue
@@ -604,7 +817,7 @@ class Client(object):
         return self._download(results, targets)
 
     def remote(self, url):
-        r = requests.head(url)
+        r = self.robust(self.transport.head)(url, timeout=self.timeout)
         reply = dict(
             location=url,
             content_length=r.headers["Content-Length"],
@@ -635,6 +848,7 @@ class Client(object):
                 except (
                     requests.exceptions.ConnectionError,
                     requests.exceptions.ReadTimeout,
+                    TransportError,
                 ) as e:
                     resp = None
                     txt = f"Connection error: [{e}]"
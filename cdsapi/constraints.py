@@ -0,0 +1,263 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Client-side validation of requests against cached dataset metadata.
+
+The form and constraints of each dataset are fetched once, stored as JSON in
+a cache directory and reused until they are older than ``ttl`` seconds. In
+offline mode the cache is used whatever its age and nothing is fetched.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import threading
+import time
+
+
+def default_cache_dir(name="constraints"):
+    cache = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache, "cdsapi", name)
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _widget_values(widget):
+    details = widget.get("details") or {}
+    values = details.get("values")
+    if values is None and "groups" in details:
+        values = []
+        for group in details["groups"]:
+            values.extend(group.get("values", []))
+    if isinstance(values, dict):
+        values = list(values)
+    return values
+
+
+class DatasetConstraints(object):
+    """Compiled form and constraints of one dataset.
+
+    ``form`` is the list of widgets of the dataset download form, ``constraints``
+    the list of valid value combinations, each a dict mapping a key to a list
+    of values. Keys without an enumerated list of values (dates, areas, ...)
+    are not checked.
+    """
+
+    def __init__(self, name, form=None, constraints=None):
+        self.name = name
+
+        self.allowed = {}
+        self.required = set()
+        for widget in form or []:
+            key = widget.get("name")
+            if not key:
+                continue
+            values = _widget_values(widget)
+            if values is not None:
+                self.allowed[key] = frozenset(str(v) for v in values)
+            if widget.get("required"):
+                self.required.add(key)
+
+        # Combinations are indexed as bitmasks: bit i is set in index[k][v]
+        # if combination i allows value v for key k, and in constrained[k]
+        # if combination i constrains key k at all
+        self.combinations = list(constraints or [])
+        self.all = (1 << len(self.combinations)) - 1
+        self.index = {}
+        self.constrained = {}
+        for i, combination in enumerate(self.combinations):
+            bit = 1 << i
+            for k, values in combination.items():
+                self.constrained[k] = self.constrained.get(k, 0) | bit
+                index = self.index.setdefault(k, {})
+                for v in _as_list(values):
+                    v = str(v)
+                    index[v] = index.get(v, 0) | bit
+
+    def normalise(self, request):
+        r = {}
+        for k, v in request.items():
+            if k in self.allowed:
+                if isinstance(v, (list, tuple)):
+                    v = [str(x) for x in v]
+                else:
+                    v = str(v)
+            r[k] = v
+        return r
+
+    def errors(self, request):
+        errors = []
+
+        for k in sorted(self.required):
+            if k not in request:
+                errors.append("Missing required key '%s'" % (k,))
+
+        selection = {}
+        for k, v in request.items():
+            values = set(str(x) for x in _as_list(v))
+            selection[k] = values
+
+            allowed = self.allowed.get(k)
+            if allowed is not None:
+                invalid = values - allowed
+                if invalid:
+                    errors.append(
+                        "Invalid value(s) for '%s': %s"
+                        % (k, ", ".join(sorted(invalid)))
+                    )
+
+        if errors or not self.combinations:
+            return errors
+
+        # Combinations compatible with the selection of each key, combinations
+        # that do not constrain a key being compatible with any value
+        keys = [k for k in selection if k in self.constrained]
+        matches = []
+        for k in keys:
+            index = self.index[k]
+            match = self.all & ~self.constrained[k]
+            for value in selection[k]:
+                match |= index.get(value, 0)
+            matches.append(match)
+
+        # Combinations compatible with all the other keys, from prefix and
+        # suffix intersections
+        after = [self.all]
+        for match in reversed(matches[1:]):
+            after.append(after[-1] & match)
+        after.reverse()
+        before = self.all
+        for i, k in enumerate(keys):
+            candidates = before & after[i] & self.constrained[k]
+            before &= matches[i]
+            if not candidates:
+                continue
+            index = self.index[k]
+            for value in selection[k]:
+                if not index.get(value, 0) & candidates:
+                    errors.append(
+                        "Value '%s' for '%s' is not available with this selection"
+                        % (value, k)
+                    )
+
+        return errors
+
+    def validate(self, request):
+        request = self.normalise(request)
+        errors = self.errors(request)
+        if errors:
+            raise Exception(
+                "Invalid request for %s: %s" % (self.name, ". ".join(errors))
+            )
+        return request
+
+
+class ConstraintsCache(object):
+    form_url = "%(url)s/resources/%(name)s/form.json"
+    constraints_url = "%(url)s/resources/%(name)s/constraints.json"
+
+    def __init__(self, client, cache_dir=None, ttl=24 * 3600, offline=False):
+        self.url = client.url
+        self.transport = client.transport
+        self.robust = client.robust
+        self.timeout = client.timeout
+        self.debug = client.debug
+
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.ttl = ttl
+        self.offline = offline
+
+        self._compiled = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, "%s.json" % (name.replace("/", "_"),))
+
+    def _fetch_json(self, template, name):
+        url = template % dict(url=self.url, name=name)
+        self.debug("GET %s", url)
+        r = self.robust(self.transport.get)(url, timeout=self.timeout)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return r.json()
+
+    def _load(self, name):
+        path = self._path(name)
+        if os.path.exists(path):
+            with open(path) as f:
+                cached = json.load(f)
+            if self.offline or time.time() - cached.get("time", 0) < self.ttl:
+                return cached
+
+        if self.offline:
+            raise Exception("No cached constraints for %s in %s" % (name, path))
+
+        cached = dict(
+            time=time.time(),
+            form=self._fetch_json(self.form_url, name),
+            constraints=self._fetch_json(self.constraints_url, name),
+        )
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(cached, f)
+        os.replace(tmp, path)
+
+        return cached
+
+    def _compiled_entry(self, name):
+        with self._lock:
+            entry = self._compiled.get(name)
+            if entry is not None and (
+                self.offline or time.time() - entry[0] < self.ttl
+            ):
+                return entry[1]
+            return None
+
+    def get(self, name):
+        constraints = self._compiled_entry(name)
+        if constraints is not None:
+            return constraints
+
+        # Concurrent callers, e.g. the scheduler threads, wait for a single
+        # load of each dataset instead of all fetching and writing the cache
+        with self._lock:
+            loading = self._loading.setdefault(name, threading.Lock())
+
+        with loading:
+            constraints = self._compiled_entry(name)
+            if constraints is not None:
+                return constraints
+
+            cached = self._load(name)
+            constraints = DatasetConstraints(
+                name, cached.get("form"), cached.get("constraints")
+            )
+            with self._lock:
+                self._compiled[name] = (cached.get("time", 0), constraints)
+            return constraints
+
+    def refresh(self, name):
+        with self._lock:
+            self._compiled.pop(name, None)
+        path = self._path(name)
+        if os.path.exists(path):
+            os.unlink(path)
+        return self.get(name)
+
+    def validate(self, name, request):
+        return self.get(name).validate(request)
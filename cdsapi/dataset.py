@@ -0,0 +1,127 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Open retrieved data as xarray datasets from a managed cache.
+
+Results are downloaded once into the cache directory, under a name derived
+from the request or the result location, and renamed into place atomically so
+that concurrent processes never see a partial file; a download spilled to
+another filesystem is first copied into the cache directory. Datasets are opened
+lazily, loading data only when it is accessed, optionally as dask arrays with
+``chunks``. All processes reading the same cached file therefore share the
+operating system page cache instead of each holding its own copy; netCDF3
+files can also be memory-mapped explicitly with ``engine="scipy"`` and
+``mmap=True``. Within a process, the last ``MAX_OPENED`` datasets are kept, so
+opening the same file again with the same options returns the already opened
+dataset; older ones are closed, releasing their file handles.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import hashlib
+import os
+import shutil
+import threading
+
+from .constraints import default_cache_dir
+from .request import request_key
+
+GRIB_EXTENSIONS = (".grib", ".grb", ".grib1", ".grib2")
+
+MAX_OPENED = 128
+
+_OPENED = collections.OrderedDict()
+_LOCK = threading.Lock()
+
+
+def cached(cache_dir, key):
+    """Path of the cached file for ``key``, or None."""
+    if not os.path.isdir(cache_dir):
+        return None
+    for name in os.listdir(cache_dir):
+        if os.path.splitext(name)[0] == key:
+            return os.path.join(cache_dir, name)
+    return None
+
+
+def download(result, cache_dir, key):
+    """Download ``result`` to the cache unless it is already there."""
+    path = cached(cache_dir, key)
+    if path is not None:
+        result.target = path
+        return path
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    ext = os.path.splitext(result.location.split("?")[0])[1]
+    path = os.path.join(cache_dir, key + ext)
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    downloaded = tmp
+    try:
+        # The download may have been spilled to another filesystem, from
+        # which it cannot be renamed into place atomically
+        downloaded = result.download(tmp)
+        if downloaded != tmp:
+            shutil.copyfile(downloaded, tmp)
+        os.replace(tmp, path)
+    finally:
+        for name in set([tmp, downloaded]):
+            if os.path.exists(name):
+                os.unlink(name)
+    result.target = path
+    return path
+
+
+def open_dataset(path, chunks=None, **kwargs):
+    try:
+        import xarray
+    except ImportError:
+        raise Exception("The 'xarray' package is required to open datasets")
+
+    if "engine" not in kwargs and path.endswith(GRIB_EXTENSIONS):
+        kwargs["engine"] = "cfgrib"
+
+    key = (path, repr(chunks), repr(sorted(kwargs.items())))
+    with _LOCK:
+        ds = _OPENED.get(key)
+        if ds is not None and os.path.exists(path):
+            _OPENED.move_to_end(key)
+            return ds
+
+    # Not under the lock, so that a slow open does not block other threads
+    ds = xarray.open_dataset(path, chunks=chunks, **kwargs)
+
+    with _LOCK:
+        evicted = [_OPENED.pop(key)] if key in _OPENED else []
+        _OPENED[key] = ds
+        while len(_OPENED) > MAX_OPENED:
+            evicted.append(_OPENED.popitem(last=False)[1])
+
+    for old in evicted:
+        old.close()
+    return ds
+
+
+def result_key(result):
+    return hashlib.sha256(result.location.encode("utf-8")).hexdigest()
+
+
+def result_to_xarray(result, cache_dir=None, **kwargs):
+    cache_dir = cache_dir or default_cache_dir("data")
+    return open_dataset(download(result, cache_dir, result_key(result)), **kwargs)
+
+
+def retrieve_dataset(client, name, request, cache_dir=None, **kwargs):
+    cache_dir = cache_dir or default_cache_dir("data")
+    key = request_key(name, request)
+    path = cached(cache_dir, key)
+    if path is None:
+        path = download(client.retrieve(name, request), cache_dir, key)
+    return open_dataset(path, **kwargs)
@@ -0,0 +1,127 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Admission control of downloads based on free disk space.
+
+Before a download starts, its size is reserved on the filesystem of the
+target. Reservations of concurrent downloads are deducted from the free space,
+so two downloads never count on the same free bytes. When the target
+filesystem is too full, the eviction hooks are called to make room, then the
+file is spilled to the first of the ``spill`` directories with enough space.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import threading
+
+
+class Reservation(object):
+    # Written bytes are handed back in steps rather than on every chunk
+    step = 1024 * 1024
+
+    def __init__(self, space, device, size, target):
+        self.space = space
+        self.device = device
+        self.size = size
+        self.target = target
+        self.written = 0
+
+    def update(self, written):
+        """Record that ``written`` bytes of the target are on disk.
+
+        The filesystem already counts them as used, so they are no longer
+        deducted from its free space.
+        """
+        written = min(written, self.size)
+        delta = written - self.written
+        if delta >= self.step or (delta > 0 and written == self.size):
+            self.space._release(self.device, delta)
+            self.written = written
+
+    def release(self):
+        if self.size > self.written:
+            self.space._release(self.device, self.size - self.written)
+        self.size = self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class DiskSpace(object):
+    def __init__(self, spill=None, margin=0, evict=None):
+        self.spill = list(spill or [])
+        self.margin = margin
+        self.evict = list(evict or [])
+
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    def add_evict_hook(self, hook):
+        """Register ``hook(directory, size)``, called to free ``size`` bytes."""
+        self.evict.append(hook)
+
+    def _device(self, directory):
+        return os.stat(directory).st_dev
+
+    def free(self, directory):
+        with self._lock:
+            return self._free(directory)
+
+    def _free(self, directory):
+        reserved = self._reserved.get(self._device(directory), 0)
+        return shutil.disk_usage(directory).free - reserved - self.margin
+
+    def _reserve(self, directory, size, target):
+        # Called with the lock held
+        if self._free(directory) < size:
+            return None
+        device = self._device(directory)
+        self._reserved[device] = self._reserved.get(device, 0) + size
+        return Reservation(self, device, size, target)
+
+    def _release(self, device, size):
+        with self._lock:
+            self._reserved[device] -= size
+            if not self._reserved[device]:
+                del self._reserved[device]
+
+    def reserve(self, target, size):
+        """Reserve ``size`` bytes for ``target``, possibly in a spill directory.
+
+        Return a ``Reservation`` whose ``target`` is the path to write to.
+        """
+        directory = os.path.dirname(os.path.abspath(target))
+        candidates = [(directory, target)]
+        for spill in self.spill:
+            candidates.append((spill, os.path.join(spill, os.path.basename(target))))
+
+        for directory, path in candidates:
+            with self._lock:
+                reservation = self._reserve(directory, size, path)
+            if reservation is not None:
+                return reservation
+
+            for hook in self.evict:
+                hook(directory, size)
+                with self._lock:
+                    reservation = self._reserve(directory, size, path)
+                if reservation is not None:
+                    return reservation
+
+        raise Exception(
+            "Not enough disk space to download %s (%s byte(s)) to %s"
+            % (target, size, ", ".join(d for d, _ in candidates))
+        )
+
+
+DEFAULT = DiskSpace()
@@ -0,0 +1,188 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Split a GRIB stream into per-field files while it is downloaded.
+
+Message boundaries are found from the total length in section 0, for GRIB
+editions 1 and 2, so each message is routed to its file as soon as it has
+been received, and the download itself is never written to disk.
+
+The target path of a message is built from a template formatted with the keys
+decoded from its header: ``edition``, ``date`` (YYYYMMDD), ``time`` (HHMM),
+``param``, ``levelType``, ``level`` and ``count``, the index of the message in
+the stream. GRIB1 parameters are ``<table>.<number>``, GRIB2 parameters
+``<discipline>.<category>.<number>``. ``route`` can be given instead of the
+template, a callable receiving the message bytes and these keys and returning
+the path, for instance to decode other keys with ecCodes.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import os
+
+from .transform import Transform
+
+
+def _uint(data, start, size):
+    return int.from_bytes(bytes(data[start : start + size]), "big")
+
+
+def message_length(data, start=0):
+    """Length of the message at ``start``, or None if more bytes are needed."""
+    if len(data) - start < 16:
+        return None
+
+    edition = data[start + 7]
+
+    if edition == 2:
+        return _uint(data, start + 8, 8)
+
+    if edition != 1:
+        raise Exception("Unsupported GRIB edition %s" % (edition,))
+
+    length = _uint(data, start + 4, 3)
+    if not length & 0x800000:
+        return length
+
+    # Messages larger than 8MB: the length is coded in units of 120 bytes,
+    # corrected with the length of section 4
+    offset = start + 8
+    if len(data) < offset + 8:
+        return None
+    flag = data[offset + 7]
+    offset += _uint(data, offset, 3)
+    for present in (flag & 0x80, flag & 0x40):
+        if present:
+            if len(data) < offset + 3:
+                return None
+            offset += _uint(data, offset, 3)
+    if len(data) < offset + 3:
+        return None
+    section4 = _uint(data, offset, 3)
+    if section4 < 120:
+        return (length & 0x7FFFFF) * 120 - section4 + 4
+    return length
+
+
+def _grib1_keys(message):
+    s = message[8:]
+    year = (s[24] - 1) * 100 + s[12]
+    return dict(
+        edition=1,
+        date="%04d%02d%02d" % (year, s[13], s[14]),
+        time="%02d%02d" % (s[15], s[16]),
+        param="%d.%d" % (s[3], s[8]),
+        levelType=s[9],
+        level=_uint(s, 10, 2),
+    )
+
+
+def _grib2_keys(message):
+    s = message[16:]
+    keys = dict(
+        edition=2,
+        date="%04d%02d%02d" % (_uint(s, 12, 2), s[14], s[15]),
+        time="%02d%02d" % (s[16], s[17]),
+        param=None,
+        levelType=None,
+        level=None,
+    )
+
+    offset = 16
+    while offset + 5 <= len(message) and message[offset : offset + 4] != b"7777":
+        length = _uint(message, offset, 4)
+        if message[offset + 4] == 4:
+            s = message[offset:]
+            keys["param"] = "%d.%d.%d" % (message[6], s[9], s[10])
+            # Product definition templates 4.0 to 4.15 share the first surface
+            if _uint(s, 7, 2) <= 15 and len(s) >= 28:
+                keys["levelType"] = s[22]
+                keys["level"] = _uint(s, 24, 4)
+            break
+        if length == 0:
+            break
+        offset += length
+
+    return keys
+
+
+def message_keys(message):
+    if message[7] == 1:
+        return _grib1_keys(message)
+    return _grib2_keys(message)
+
+
+class GribSplitter(Transform):
+    output = False
+
+    def __init__(self, template=None, route=None, max_open=64):
+        if (template is None) == (route is None):
+            raise Exception("GribSplitter needs either a template or a route")
+        self.template = template
+        self.route = route
+        self.max_open = max_open
+
+        self.buffer = bytearray()
+        self.count = 0
+        self.paths = collections.OrderedDict()
+        self._files = collections.OrderedDict()
+
+    def _path(self, message):
+        keys = message_keys(message)
+        keys["count"] = self.count
+        if self.route is not None:
+            return self.route(message, keys)
+        return self.template.format(**keys)
+
+    def _file(self, path):
+        f = self._files.pop(path, None)
+        if f is None:
+            if len(self._files) >= self.max_open:
+                self._files.popitem(last=False)[1].close()
+            # Truncate on first use, append when reopened after eviction
+            mode = "ab" if path in self.paths else "wb"
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            f = open(path, mode)
+        self._files[path] = f
+        return f
+
+    def _write(self, message):
+        path = self._path(message)
+        self._file(path).write(message)
+        self.paths[path] = self.paths.get(path, 0) + 1
+        self.count += 1
+
+    def write(self, f, chunk):
+        self.buffer.extend(chunk)
+        offset = 0
+        while True:
+            start = self.buffer.find(b"GRIB", offset)
+            if start < 0:
+                # Keep a possibly split "GRIB" marker
+                offset = max(offset, len(self.buffer) - 3)
+                break
+            length = message_length(self.buffer, start)
+            if length is None or len(self.buffer) - start < length:
+                offset = start
+                break
+            self._write(bytes(self.buffer[start : start + length]))
+            offset = start + length
+        del self.buffer[:offset]
+
+    def finish(self, f):
+        if self.buffer.find(b"GRIB") >= 0:
+            raise Exception("Truncated GRIB message at the end of the download")
+        for handle in self._files.values():
+            handle.flush()
+
+    def close(self):
+        while self._files:
+            self._files.popitem()[1].close()
@@ -0,0 +1,195 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Overlap retrieves with the processing of their downloaded files.
+
+Retrieves go through a ``Scheduler``, and each downloaded target is handed to
+an executor, by default a ``ProcessPoolExecutor``, which runs the callable
+registered for that job while the next requests are submitted, queued and
+downloaded. At most ``max_pending`` jobs are in flight: when processing falls
+behind, ``submit()`` blocks instead of filling the disk with unprocessed
+files.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+
+from .scheduler import Scheduler
+
+
+def _process(process, target, args, kwargs):
+    start = time.time()
+    result = process(target, *args, **kwargs)
+    return result, start, time.time()
+
+
+class PipelineJob(object):
+    def __init__(self, job, process, args, kwargs):
+        self.job = job
+        self.process = process
+        self.args = args
+        self.kwargs = kwargs
+
+        self.processing_queued = None
+        self.processing_started = None
+        self.processing_finished = None
+
+        self.future = Future()
+
+    @property
+    def target(self):
+        return self.job.target
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+    @property
+    def timings(self):
+        """Seconds spent in each stage, for the stages reached so far."""
+        job = self.job
+        stages = [
+            ("queued", job.queued, job.started),
+            ("request", job.started, job.completed),
+            ("download", job.completed, job.finished),
+            ("processing_queued", self.processing_queued, self.processing_started),
+            ("processing", self.processing_started, self.processing_finished),
+        ]
+        return dict(
+            (name, end - start)
+            for name, start, end in stages
+            if start is not None and end is not None
+        )
+
+
+class Pipeline(object):
+    def __init__(
+        self,
+        client,
+        max_active=4,
+        executor=None,
+        processes=None,
+        max_pending=None,
+        **kwargs,
+    ):
+        self.scheduler = Scheduler(client, max_active=max_active, **kwargs)
+
+        self.own_executor = executor is None
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=processes)
+        self.executor = executor
+
+        if max_pending is None:
+            max_pending = 2 * max_active + (processes or 4)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        # Only the jobs still in flight, finished ones belong to the caller
+        self._jobs = set()
+        self._lock = threading.Lock()
+
+    def submit(self, name, request, target, process=None, *args, **kwargs):
+        """Retrieve ``request`` to ``target``, then run ``process(target, ...)``.
+
+        ``process`` must be picklable when the executor is a process pool.
+        ``priority`` and ``deadline`` are passed to the scheduler.
+        """
+        priority = kwargs.pop("priority", 0)
+        deadline = kwargs.pop("deadline", None)
+
+        self._slots.acquire()
+        try:
+            job = self.scheduler.submit(
+                name, request, target, priority=priority, deadline=deadline
+            )
+        except Exception:
+            self._slots.release()
+            raise
+
+        pjob = PipelineJob(job, process, args, kwargs)
+        with self._lock:
+            self._jobs.add(pjob)
+        pjob.future.add_done_callback(lambda f: self._discard(pjob))
+        job.future.add_done_callback(lambda f: self._retrieved(pjob, f))
+        return pjob
+
+    def _retrieved(self, pjob, future):
+        if future.cancelled() or future.exception() is not None:
+            self._slots.release()
+            if future.cancelled():
+                pjob.future.cancel()
+            else:
+                pjob.future.set_exception(future.exception())
+            return
+
+        if pjob.process is None:
+            self._slots.release()
+            pjob.future.set_result(pjob.target)
+            return
+
+        pjob.processing_queued = time.time()
+        try:
+            processed = self.executor.submit(
+                _process, pjob.process, pjob.target, pjob.args, pjob.kwargs
+            )
+        except BaseException as e:
+            # E.g. the executor was shut down or its process pool is broken
+            self._slots.release()
+            pjob.future.set_exception(e)
+            return
+        processed.add_done_callback(lambda f: self._processed(pjob, f))
+
+    def _processed(self, pjob, future):
+        self._slots.release()
+        try:
+            result, pjob.processing_started, pjob.processing_finished = future.result()
+        except BaseException as e:
+            pjob.future.set_exception(e)
+            return
+        pjob.future.set_result(result)
+
+    def _discard(self, pjob):
+        with self._lock:
+            self._jobs.discard(pjob)
+
+    def _pending(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def as_completed(self, timeout=None):
+        """Yield the jobs in flight as their processing completes."""
+        futures = dict((pjob.future, pjob) for pjob in self._pending())
+        for future in as_completed(futures, timeout):
+            yield futures[future]
+
+    def stats(self):
+        stats = self.scheduler.stats()
+        stats["processing"] = len(
+            [j for j in self._pending() if j.processing_queued and not j.done()]
+        )
+        return stats
+
+    def close(self, wait=True):
+        self.scheduler.close(wait)
+        if wait:
+            for pjob in self._pending():
+                try:
+                    pjob.result()
+                except BaseException:
+                    pass
+        if self.own_executor:
+            self.executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
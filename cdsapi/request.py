@@ -0,0 +1,167 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Compact requests, expanded only when they are sent.
+
+Ranges of dates, times or levels are kept as ``DateRange``, ``TimeRange`` and
+``Range`` objects and expanded to the list of values expected by the CDS when
+the request is serialised. A ``Request`` caches its expanded form and its
+canonical JSON encoding, so hashing, validating and resubmitting it does not
+expand or encode it again.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import hashlib
+import json
+import math
+
+
+def _date(value):
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def _minutes(value):
+    if isinstance(value, int):
+        return value * 60
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+class Range(object):
+    """Numeric values from ``start`` to ``stop`` included."""
+
+    def __init__(self, start, stop, step=1):
+        # step * 0 is the zero of the step type, e.g. timedelta(0)
+        if not step > step * 0:
+            raise Exception("Invalid range step [%s], it must be positive" % (step,))
+        self.start = start
+        self.stop = stop
+        self.step = step
+
+    def __iter__(self):
+        if self.stop < self.start:
+            return
+        # Computed from the start, rather than accumulated, so that floating
+        # point errors do not add up and drop the last value
+        count = int(math.floor((self.stop - self.start) / self.step + 1e-9))
+        yield self.start
+        for i in range(1, count + 1):
+            value = self.start + i * self.step
+            if isinstance(value, float):
+                value = round(value, 12)
+            yield value
+
+    def toJSON(self):
+        return [str(x) for x in self]
+
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (
+            self.__class__.__name__,
+            self.start,
+            self.stop,
+            self.step,
+        )
+
+
+class DateRange(Range):
+    """Dates from ``start`` to ``stop`` included, every ``step`` days."""
+
+    def __init__(self, start, stop, step=1):
+        super().__init__(_date(start), _date(stop), datetime.timedelta(days=step))
+
+    def toJSON(self):
+        return [x.strftime("%Y-%m-%d") for x in self]
+
+
+class TimeRange(Range):
+    """Times of the day as ``HH:MM``, every ``step`` hours."""
+
+    def __init__(self, start="00:00", stop="23:00", step=1):
+        super().__init__(_minutes(start), _minutes(stop), int(step * 60))
+
+    def toJSON(self):
+        return ["%02d:%02d" % divmod(x, 60) for x in self]
+
+
+def toJSON(obj):
+    to_json = getattr(obj, "toJSON", None)
+    if callable(to_json):
+        return to_json()
+
+    if isinstance(obj, (list, tuple)):
+        return [toJSON(x) for x in obj]
+
+    if isinstance(obj, dict):
+        r = {}
+        for k, v in obj.items():
+            r[k] = toJSON(v)
+        return r
+
+    return obj
+
+
+class Request(object):
+    def __init__(self, request=None, **kwargs):
+        self._items = dict(request or {})
+        self._items.update(kwargs)
+        self._expanded = None
+        self._encoded = None
+
+    def update(self, request=None, **kwargs):
+        self._items.update(request or {}, **kwargs)
+        self._expanded = None
+        self._encoded = None
+        return self
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def toJSON(self):
+        if self._expanded is None:
+            self._expanded = toJSON(self._items)
+        return self._expanded
+
+    def encode(self):
+        """Canonical JSON encoding of the expanded request."""
+        if self._encoded is None:
+            self._encoded = json.dumps(
+                self.toJSON(), sort_keys=True, separators=(",", ":")
+            )
+        return self._encoded
+
+    def key(self):
+        return hashlib.sha256(self.encode().encode("utf-8")).hexdigest()
+
+    def __repr__(self):
+        return "Request(%r)" % (self._items,)
+
+
+def encode(request):
+    """Return the JSON body of ``request``, reusing the cache of a ``Request``."""
+    if isinstance(request, Request):
+        return request.encode()
+    return json.dumps(toJSON(request), sort_keys=True, separators=(",", ":"))
+
+
+def request_key(name, request):
+    """Hash identifying the retrieve of ``request`` from dataset ``name``."""
+    encoded = json.dumps([name, toJSON(request)], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
@@ -0,0 +1,246 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Client-side scheduling of retrieve requests.
+
+Requests are queued locally and only submitted to the CDS when one of the
+``max_active`` slots is free. The next request is the one with the highest
+priority, then the earliest deadline, then the oldest; a dataset never has
+more than its concurrency limit of requests active. Queued requests can be
+cancelled, or held back while more urgent ones run, since nothing has been
+sent to the server yet. A request still queued when its deadline passes is
+failed.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from .request import toJSON
+
+
+class Job(object):
+    def __init__(self, name, request, target, priority, deadline, seq):
+        self.name = name
+        self.request = request
+        self.target = target
+        self.priority = priority
+        self.deadline = deadline
+        self.seq = seq
+
+        self.queued = time.time()
+        self.started = None
+        self.completed = None
+        self.finished = None
+
+        self.future = Future()
+
+    def sort_key(self):
+        deadline = self.deadline if self.deadline is not None else float("inf")
+        return (-self.priority, deadline, self.seq)
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+    @property
+    def wait_time(self):
+        if self.started is None:
+            return time.time() - self.queued
+        return self.started - self.queued
+
+    def __repr__(self):
+        return "Job(name=%s,priority=%s,deadline=%s)" % (
+            self.name,
+            self.priority,
+            self.deadline,
+        )
+
+
+class Scheduler(object):
+    def __init__(self, client, max_active=4, dataset_limits=None, default_limit=None):
+        self.client = client
+        self.max_active = max_active
+        self.dataset_limits = dict(dataset_limits or {})
+        self.default_limit = default_limit
+
+        self._queue = []
+        self._active = {}
+        self._running = []
+        self._preempt = None
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._counts = dict(completed=0, failed=0, expired=0, cancelled=0)
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        self._threads = []
+        for i in range(max_active):
+            thread = threading.Thread(
+                target=self._run, name="cdsapi-scheduler-%s" % (i,), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, name, request, target=None, priority=0, deadline=None):
+        """Queue a retrieve; ``deadline`` is an absolute ``time.time()`` value."""
+        with self._cond:
+            if self._closed:
+                raise Exception("Scheduler is closed")
+            job = Job(name, request, target, priority, deadline, next(self._seq))
+            self._queue.append(job)
+            self._cond.notify_all()
+        return job
+
+    def cancel(self, job):
+        with self._cond:
+            if job not in self._queue:
+                return False
+            self._queue.remove(job)
+            self._counts["cancelled"] += 1
+        job.future.cancel()
+        return True
+
+    def preempt(self, priority):
+        """Hold back jobs with a priority lower than ``priority``.
+
+        They stay queued, and are not started as long as a job of at least
+        ``priority`` is queued or running, even if a slot is free. Return the
+        jobs held back.
+        """
+        with self._cond:
+            self._preempt = priority
+            self._cond.notify_all()
+            return [j for j in self._queue if j.priority < priority]
+
+    def _limit(self, name):
+        return self.dataset_limits.get(name, self.default_limit)
+
+    def _next(self):
+        # Called with the lock held
+        now = time.time()
+        for job in [j for j in self._queue if j.deadline is not None]:
+            if job.deadline < now:
+                self._queue.remove(job)
+                job.finished = now
+                # The future may have been cancelled directly by the caller
+                if not job.future.set_running_or_notify_cancel():
+                    self._counts["cancelled"] += 1
+                    continue
+                self._counts["expired"] += 1
+                job.future.set_exception(
+                    Exception("Deadline expired before %r was submitted" % (job,))
+                )
+
+        # Preemption ends when no urgent job is left
+        if self._preempt is not None and not any(
+            j.priority >= self._preempt for j in self._queue + self._running
+        ):
+            self._preempt = None
+
+        best = None
+        for job in self._queue:
+            if self._preempt is not None and job.priority < self._preempt:
+                continue
+            limit = self._limit(job.name)
+            if limit is not None and self._active.get(job.name, 0) >= limit:
+                continue
+            if best is None or job.sort_key() < best.sort_key():
+                best = job
+
+        if best is not None:
+            self._queue.remove(best)
+            self._active[best.name] = self._active.get(best.name, 0) + 1
+            self._running.append(best)
+            best.started = now
+            self._wait_total += best.wait_time
+            self._wait_max = max(self._wait_max, best.wait_time)
+        return best
+
+    def _execute(self, job):
+        client = self.client
+        if client.validate:
+            job.request = client.constraints.validate(job.name, toJSON(job.request))
+        reply = client._submit(
+            "%s/resources/%s" % (client.url, job.name), job.request, "POST"
+        )
+        result = client._wait(reply)
+        job.completed = time.time()
+        if job.target is not None:
+            # The download may have been spilled elsewhere
+            job.target = result.download(job.target)
+        return result
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._next()
+                while job is None:
+                    if self._closed and not self._queue:
+                        return
+                    # Wake up regularly to expire jobs past their deadline
+                    self._cond.wait(1)
+                    job = self._next()
+
+            # The future may have been cancelled directly by the caller
+            if not job.future.set_running_or_notify_cancel():
+                outcome = "cancelled"
+            else:
+                try:
+                    job.future.set_result(self._execute(job))
+                    outcome = "completed"
+                except Exception as e:
+                    job.future.set_exception(e)
+                    outcome = "failed"
+
+            with self._cond:
+                job.finished = time.time()
+                self._active[job.name] -= 1
+                self._running.remove(job)
+                self._counts[outcome] += 1
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            active = sum(self._active.values())
+            started = self._counts["completed"] + self._counts["failed"] + active
+            queued = {}
+            for job in self._queue:
+                queued[job.name] = queued.get(job.name, 0) + 1
+            stats = dict(
+                queued=len(self._queue),
+                queued_per_dataset=queued,
+                active=active,
+                active_per_dataset=dict((k, v) for k, v in self._active.items() if v),
+                wait_mean=self._wait_total / started if started else 0.0,
+                wait_max=self._wait_max,
+                oldest_wait=max([j.wait_time for j in self._queue] or [0.0]),
+            )
+            stats.update(self._counts)
+            return stats
+
+    def close(self, wait=True):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,193 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Stream transforms applied to downloaded data on its way to disk.
+
+A transform receives the downloaded chunks in order through ``write(f, chunk)``
+and writes whatever it produces to the open file ``f``. ``finish(f)`` is
+called once, after the last chunk, to flush any buffered output, and
+``close()`` always runs at the end of the download to release resources.
+The file object may change between calls when a download is resumed.
+
+A transform holds the state of a single stream, so an instance can only be
+used for one download and ``start()`` raises when it is reused. Codec names
+and callables give a new transform for each download.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import os
+import zlib
+
+
+class Transform(object):
+    # False for transforms writing their own files, listed in ``paths``,
+    # instead of the target
+    output = True
+
+    # True once used by a download
+    started = False
+
+    def start(self):
+        if self.started:
+            raise Exception(
+                "%s already used, create one for each download"
+                % (type(self).__name__,)
+            )
+        self.started = True
+
+    def write(self, f, chunk):
+        f.write(chunk)
+
+    def finish(self, f):
+        pass
+
+    def close(self):
+        pass
+
+
+class CallbackTransform(Transform):
+    """Pass each chunk to ``callback``.
+
+    If the callback returns bytes they are written instead of the chunk,
+    if it returns ``None`` the chunk is written unchanged.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, f, chunk):
+        data = self.callback(chunk)
+        f.write(chunk if data is None else data)
+
+
+def _compressor(codec, level):
+    if codec == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    if codec == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("The 'zstandard' package is required for zstd compression")
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    raise Exception("Unsupported compression codec [%s]" % (codec,))
+
+
+def _compress_block(codec, level, block):
+    compressor = _compressor(codec, level)
+    return compressor.compress(block) + compressor.flush()
+
+
+class CompressTransform(Transform):
+    """Compress the stream with ``gzip`` or ``zstd`` (requires ``zstandard``)."""
+
+    def __init__(self, codec="gzip", level=None):
+        if level is None:
+            level = 6 if codec == "gzip" else 3
+        self.codec = codec
+        self.level = level
+        self.compressor = _compressor(codec, level)
+
+    def write(self, f, chunk):
+        data = self.compressor.compress(chunk)
+        if data:
+            f.write(data)
+
+    def finish(self, f):
+        f.write(self.compressor.flush())
+
+
+class ParallelCompressTransform(Transform):
+    """Compress the stream in independent blocks on an executor.
+
+    Both gzip members and zstd frames can be concatenated, so each
+    ``block_size`` block is compressed on its own, typically by a
+    ``concurrent.futures.ProcessPoolExecutor``, and written back in order.
+    At most ``max_pending`` blocks are in flight; beyond that the download
+    waits for the oldest one, so a slow codec throttles the network read
+    instead of buffering the whole file in memory.
+    """
+
+    def __init__(
+        self,
+        codec="gzip",
+        level=None,
+        executor=None,
+        workers=None,
+        block_size=4 * 1024 * 1024,
+        max_pending=None,
+    ):
+        if level is None:
+            level = 6 if codec == "gzip" else 3
+
+        # Fail early on an unknown codec or missing package
+        _compressor(codec, level)
+
+        self.codec = codec
+        self.level = level
+        self.block_size = block_size
+
+        if max_pending is None:
+            if workers is None:
+                if executor is not None:
+                    raise Exception("max_pending or workers is required with executor")
+                workers = os.cpu_count() or 1
+            max_pending = 2 * workers
+        self.max_pending = max_pending
+
+        self.own_executor = executor is None
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            executor = ProcessPoolExecutor(max_workers=workers)
+        self.executor = executor
+
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+
+    def _submit(self, f, block):
+        self.pending.append(
+            self.executor.submit(_compress_block, self.codec, self.level, block)
+        )
+        while len(self.pending) > self.max_pending:
+            f.write(self.pending.popleft().result())
+
+    def write(self, f, chunk):
+        self.buffer.extend(chunk)
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+            self._submit(f, block)
+
+    def finish(self, f):
+        if self.buffer:
+            self._submit(f, bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown()
+
+
+def get_transform(transform):
+    """Return a transform from a codec name, a callable or a transform."""
+    if transform is None or isinstance(transform, Transform):
+        return transform
+
+    if transform in ("gzip", "zstd"):
+        return CompressTransform(transform)
+
+    if callable(transform):
+        return CallbackTransform(transform)
+
+    raise Exception("Invalid download transform [%s]" % (transform,))
@@ -0,0 +1,278 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""HTTP transports used by the client.
+
+A transport performs the few kinds of calls the client needs: submitting a
+JSON request, getting a JSON document, streaming bytes from an offset, and
+HEAD and DELETE requests. They all return a response with the interface of a
+``requests.Response`` (``status_code``, ``reason``, ``headers``, ``text``,
+``json()``, ``raise_for_status()``, ``iter_content()`` and ``close()``), and
+raise ``TransportError`` when the server cannot be reached, which the client
+retries.
+
+``requests`` is the default. The ``httpx`` backend (with optional HTTP/2
+multiplexing) and the ``urllib3`` backend require the corresponding package.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import base64
+import json
+
+import requests
+
+
+class TransportError(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class Response(object):
+    """Response of a non-requests backend."""
+
+    def __init__(self, status_code, reason, headers, content=None, chunks=None):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self._content = content
+        self._chunks = chunks
+        self._close = []
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content())
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise HTTPError("%s %s" % (self.status_code, self.reason), self)
+
+    def iter_content(self, chunk_size=1024):
+        if self._chunks is None:
+            yield self._content or b""
+            return
+        chunks, self._chunks = self._chunks, None
+        for chunk in chunks(chunk_size):
+            yield chunk
+
+    def on_close(self, callback):
+        self._close.append(callback)
+
+    def close(self):
+        for callback in self._close:
+            callback()
+        self._close = []
+
+
+class Transport(object):
+    """Base class of the transports.
+
+    Subclasses only have to implement ``request()``, all the other calls go
+    through it. ``close()`` may be overridden to release connections.
+    """
+
+    def __init__(self, auth=None, headers=None, verify=True):
+        self.auth = auth
+        self.headers = dict(headers or {})
+        self.verify = verify
+
+    def request(self, method, url, body=None, headers=None, stream=False, timeout=None):
+        """Send a request and return its response.
+
+        The body is not read when ``stream`` is true, and connection errors
+        raise ``TransportError``.
+        """
+        raise NotImplementedError(
+            "%s must implement request()" % (type(self).__name__,)
+        )
+
+    def submit(self, method, url, body, timeout=None):
+        headers = {"Content-Type": "application/json"}
+        return self.request(method, url, body=body, headers=headers, timeout=timeout)
+
+    def get(self, url, timeout=None):
+        return self.request("GET", url, timeout=timeout)
+
+    def stream(self, url, start=0, timeout=None):
+        headers = {"Range": "bytes=%d-" % (start,)} if start else None
+        return self.request("GET", url, headers=headers, stream=True, timeout=timeout)
+
+    def head(self, url, timeout=None):
+        return self.request("HEAD", url, timeout=timeout)
+
+    def delete(self, url, timeout=None):
+        return self.request("DELETE", url, timeout=timeout)
+
+    def close(self):
+        pass
+
+    def _basic_auth(self):
+        token = ("%s:%s" % tuple(self.auth)).encode("utf-8")
+        return "Basic %s" % (base64.b64encode(token).decode("ascii"),)
+
+
+class RequestsTransport(Transport):
+    def __init__(self, auth=None, headers=None, verify=True, session=None):
+        super().__init__(auth, headers, verify)
+        self.session = session if session is not None else requests.Session()
+        self.session.auth = auth
+        self.session.headers = self.headers
+
+    def request(self, method, url, body=None, headers=None, stream=False, timeout=None):
+        try:
+            return self.session.request(
+                method,
+                url,
+                data=body,
+                headers=headers,
+                stream=stream,
+                verify=self.verify,
+                timeout=timeout,
+            )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+        ) as e:
+            raise TransportError(str(e))
+
+    def close(self):
+        self.session.close()
+
+
+class HttpxTransport(Transport):
+    def __init__(self, auth=None, headers=None, verify=True, http2=False):
+        super().__init__(auth, headers, verify)
+        try:
+            import httpx
+        except ImportError:
+            raise Exception("The 'httpx' package is required for the httpx transport")
+        self.httpx = httpx
+        self.client = httpx.Client(
+            auth=auth, headers=self.headers, verify=verify, http2=http2
+        )
+
+    def request(self, method, url, body=None, headers=None, stream=False, timeout=None):
+        httpx = self.httpx
+        try:
+            request = self.client.build_request(
+                method, url, content=body, headers=headers, timeout=timeout
+            )
+            r = self.client.send(request, stream=stream)
+        except httpx.TransportError as e:
+            raise TransportError(str(e))
+
+        def chunks(chunk_size):
+            try:
+                for chunk in r.iter_bytes(chunk_size):
+                    yield chunk
+            except httpx.TransportError as e:
+                raise TransportError(str(e))
+
+        response = Response(
+            r.status_code,
+            r.reason_phrase,
+            r.headers,
+            content=None if stream else r.content,
+            chunks=chunks if stream else None,
+        )
+        response.on_close(r.close)
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+class Urllib3Transport(Transport):
+    def __init__(self, auth=None, headers=None, verify=True, maxsize=10):
+        super().__init__(auth, headers, verify)
+        try:
+            import urllib3
+        except ImportError:
+            raise Exception(
+                "The 'urllib3' package is required for the urllib3 transport"
+            )
+        self.urllib3 = urllib3
+        if auth is not None:
+            self.headers["Authorization"] = self._basic_auth()
+        self.pool = urllib3.PoolManager(
+            maxsize=maxsize, cert_reqs="CERT_REQUIRED" if verify else "CERT_NONE"
+        )
+
+    def request(self, method, url, body=None, headers=None, stream=False, timeout=None):
+        urllib3 = self.urllib3
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        try:
+            r = self.pool.request(
+                method,
+                url,
+                body=body,
+                headers=all_headers,
+                preload_content=not stream,
+                timeout=timeout,
+                retries=False,
+            )
+        except urllib3.exceptions.HTTPError as e:
+            raise TransportError(str(e))
+
+        def chunks(chunk_size):
+            try:
+                for chunk in r.stream(chunk_size):
+                    yield chunk
+            except urllib3.exceptions.HTTPError as e:
+                raise TransportError(str(e))
+
+        response = Response(
+            r.status,
+            r.reason,
+            r.headers,
+            content=None if stream else r.data,
+            chunks=chunks if stream else None,
+        )
+        response.on_close(r.release_conn)
+        return response
+
+    def close(self):
+        self.pool.clear()
+
+
+TRANSPORTS = {
+    "requests": RequestsTransport,
+    "httpx": HttpxTransport,
+    "urllib3": Urllib3Transport,
+}
+
+
+def get_transport(transport, auth=None, headers=None, verify=True, session=None):
+    if isinstance(transport, Transport):
+        return transport
+
+    if transport is None:
+        transport = "requests"
+
+    if transport not in TRANSPORTS:
+        raise Exception("Unknown transport [%s]" % (transport,))
+
+    if transport == "requests":
+        return RequestsTransport(auth, headers, verify, session=session)
+
+    return TRANSPORTS[transport](auth, headers, verify)
@@ -0,0 +1,296 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Retrieve jobs shared between several processes or nodes.
+
+The queue is a SQLite database, normally on a shared filesystem, relying on
+SQLite's file locking to coordinate the workers. A worker claims a job for
+``lease`` seconds and renews the lease while it runs; a job whose lease has
+expired, because its worker died, is claimed again by the next worker. The
+CDS ``request_id`` of a job is recorded as soon as it is known, so a reclaimed
+job resumes polling the existing request instead of submitting a new one.
+
+Jobs are identified by a hash of the dataset name and request, so the same
+retrieve submitted from several nodes is only executed once.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from .request import request_key, toJSON
+from .transform import CallbackTransform
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    request TEXT NOT NULL,
+    target TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    request_id TEXT,
+    progress INTEGER DEFAULT 0,
+    size INTEGER,
+    tries INTEGER DEFAULT 0,
+    error TEXT,
+    created REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created);
+"""
+
+
+class WorkQueue(object):
+    def __init__(self, path, worker=None, lease=600, retry_max=3, timeout=300):
+        self.path = path
+        self.worker = worker or "%s:%s:%s" % (
+            socket.gethostname(),
+            os.getpid(),
+            uuid.uuid4().hex[:8],
+        )
+        if lease <= 0:
+            raise Exception("Invalid lease [%s], it must be positive" % (lease,))
+        self.lease = lease
+        self.retry_max = retry_max
+        self.timeout = timeout
+
+        self._local = threading.local()
+
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def submit(self, name, request, target):
+        key = request_key(name, request)
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR IGNORE INTO jobs (key, name, request, target, state,"
+                " created, updated) VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+                (key, name, json.dumps(toJSON(request)), target, now, now),
+            )
+        return key
+
+    def claim(self):
+        now = time.time()
+        with self._transaction() as db:
+            # A job whose worker keeps dying, for instance killed when out of
+            # memory, is not retried forever
+            db.execute(
+                "UPDATE jobs SET state = 'failed', lease_until = NULL,"
+                " error = 'Lease expired after ' || tries || ' tries', updated = ?"
+                " WHERE state = 'running' AND lease_until < ? AND tries >= ?",
+                (now, now, self.retry_max),
+            )
+            row = db.execute(
+                "SELECT * FROM jobs WHERE state = 'pending'"
+                " OR (state = 'running' AND lease_until < ?)"
+                " ORDER BY created LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?,"
+                " tries = tries + 1, updated = ? WHERE key = ?",
+                (self.worker, now + self.lease, now, row["key"]),
+            )
+        return self.job(row["key"])
+
+    def _update(self, key, **values):
+        values["updated"] = time.time()
+        columns = ", ".join("%s = ?" % (k,) for k in values)
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET %s WHERE key = ? AND worker = ?" % (columns,),
+                list(values.values()) + [key, self.worker],
+            )
+        # False if the lease expired and another worker took the job over
+        return cursor.rowcount == 1
+
+    def heartbeat(self, key, **values):
+        return self._update(key, lease_until=time.time() + self.lease, **values)
+
+    def complete(self, key, target=None):
+        values = dict(state="completed", lease_until=None, error=None)
+        if target is not None:
+            values["target"] = target
+        return self._update(key, **values)
+
+    def fail(self, key, error):
+        job = self.job(key)
+        if job is not None and job["tries"] < self.retry_max:
+            state = "pending"
+        else:
+            state = "failed"
+        # Do not resume a request that failed on the server
+        return self._update(
+            key, state=state, lease_until=None, request_id=None, error=str(error)
+        )
+
+    def job(self, key):
+        row = self.db.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return dict(row)
+
+    def stats(self):
+        rows = self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+        return dict((state, count) for state, count in rows)
+
+    def wait(self, key, poll=10, timeout=None):
+        """Wait for a job, possibly run by another node, and return its target."""
+        start = time.time()
+        while True:
+            job = self.job(key)
+            if job is None:
+                raise Exception("Unknown job %s" % (key,))
+            if job["state"] == "completed":
+                return job["target"]
+            if job["state"] == "failed":
+                raise Exception("Job %s failed: %s" % (key, job["error"]))
+            if timeout is not None and time.time() - start > timeout:
+                raise Exception("Timeout waiting for job %s" % (key,))
+            time.sleep(poll)
+
+    def _execute(self, client, job, lost=None):
+        key = job["key"]
+        lost = lost or threading.Event()
+
+        if job["request_id"]:
+            client.info("Resuming request %s", job["request_id"])
+            reply = dict(request_id=job["request_id"], state="queued")
+        else:
+            request = json.loads(job["request"])
+            if client.validate:
+                request = client.constraints.validate(job["name"], request)
+            reply = client._submit(
+                "%s/resources/%s" % (client.url, job["name"]), request, "POST"
+            )
+            self.heartbeat(key, request_id=reply["request_id"])
+
+        result = client._wait(reply)
+        if lost.is_set():
+            raise Exception("Lease of job %s lost" % (key,))
+        self.heartbeat(key, size=result.content_length)
+
+        progress = dict(total=0, time=time.time())
+
+        def record(chunk):
+            if lost.is_set():
+                raise Exception("Lease of job %s lost" % (key,))
+            progress["total"] += len(chunk)
+            if time.time() - progress["time"] > 10:
+                progress["time"] = time.time()
+                # Only informative, the lease is renewed by _renew()
+                try:
+                    self.heartbeat(key, progress=progress["total"])
+                except Exception as e:
+                    client.debug("Could not record progress of job %s: %s", key, e)
+
+        # Download next to the target so that a worker whose lease was taken
+        # over never overwrites the file of the new owner
+        part = "%s.%s.part" % (job["target"], self.worker.replace(":", "-"))
+        try:
+            path = result.download(part, transform=CallbackTransform(record))
+        except Exception:
+            if os.path.exists(part):
+                os.unlink(part)
+            raise
+
+        # The download may have been spilled to another filesystem, where the
+        # file then stays under the name of the target
+        target = os.path.join(os.path.dirname(path), os.path.basename(job["target"]))
+
+        if self.heartbeat(key, progress=progress["total"]):
+            os.replace(path, target)
+            self.complete(key, target=target)
+        else:
+            client.warning("Job %s was taken over by another worker", key)
+            os.unlink(path)
+
+    def _renew(self, client, key, stop, lost):
+        # Set ``lost`` once the job has been taken over, or could not be
+        # renewed before its lease expired, e.g. on a busy shared filesystem
+        renewed = time.time()
+        while not stop.wait(self.lease / 3.0):
+            try:
+                if self.heartbeat(key):
+                    renewed = time.time()
+                    continue
+                client.warning("Job %s was taken over by another worker", key)
+            except Exception as e:
+                client.warning("Could not renew the lease of job %s: %s", key, e)
+                if time.time() - renewed < self.lease:
+                    continue
+            lost.set()
+            return
+
+    def run(self, client, poll=10, wait=False):
+        """Execute jobs with ``client`` until the queue is empty.
+
+        With ``wait=True``, keep polling for new jobs instead of returning.
+        """
+        while True:
+            job = self.claim()
+            if job is None:
+                if not wait:
+                    return
+                time.sleep(poll)
+                continue
+
+            key = job["key"]
+            client.info("Claimed job %s (%s)", key, job["name"])
+
+            stop = threading.Event()
+            lost = threading.Event()
+            renew = threading.Thread(
+                target=self._renew, args=(client, key, stop, lost), daemon=True
+            )
+            renew.start()
+            try:
+                self._execute(client, job, lost)
+            except Exception as e:
+                if lost.is_set():
+                    # Left to the worker claiming it next, which resumes the
+                    # request on the server
+                    client.warning("Job %s stopped: %s", key, e)
+                else:
+                    client.error("Job %s failed: %s", key, e)
+                    self.fail(key, e)
+            finally:
+                stop.set()
+                renew.join()
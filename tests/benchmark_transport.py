@@ -0,0 +1,94 @@
+# (C) Copyright 2018 ECMWF.
+#
+# This software is licensed under the terms of the Apache Licence Version 2.0
+# which can be obtained at http://www.apache.org/licenses/LICENSE-2.0.
+# In applying this licence, ECMWF does not waive the privileges and immunities
+# granted to it by virtue of its status as an intergovernmental organisation nor
+# does it submit to any jurisdiction.
+
+"""Compare the HTTP transports against a local mock server.
+
+    $ python tests/benchmark_transport.py [polls] [megabytes]
+
+Reports the mean latency of polling a task and the throughput of streaming a
+file, for every transport whose package is installed.
+"""
+
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cdsapi import transport
+
+BLOCK = b"\0" * (1024 * 1024)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/tasks/"):
+            body = json.dumps(dict(request_id="1", state="running")).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        size = int(self.path.split("/")[-1]) * len(BLOCK)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        for _ in range(size // len(BLOCK)):
+            self.wfile.write(BLOCK)
+
+
+def benchmark(name, url, polls, megabytes):
+    try:
+        t = transport.get_transport(name, auth=("user", "key"))
+    except Exception as e:
+        print("%-10s skipped: %s" % (name, e))
+        return
+
+    start = time.time()
+    for _ in range(polls):
+        r = t.get("%s/tasks/1" % (url,), timeout=10)
+        r.raise_for_status()
+        r.json()
+    latency = (time.time() - start) / polls
+
+    start = time.time()
+    r = t.stream("%s/data/%s" % (url, megabytes), timeout=10)
+    total = 0
+    for chunk in r.iter_content(chunk_size=1024 * 1024):
+        total += len(chunk)
+    r.close()
+    rate = total / (time.time() - start) / 1024 / 1024
+
+    t.close()
+    print("%-10s poll %8.3f ms  download %8.1f MB/s" % (name, latency * 1000, rate))
+
+
+def main():
+    polls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%s" % (server.server_address[1],)
+
+    for name in sorted(transport.TRANSPORTS):
+        benchmark(name, url, polls, megabytes)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,28 @@
+import concurrent.futures
+import gzip
+import io
 import os
+import sqlite3
+import sys
+import threading
+import time
 
 import ecmwf.datastores.legacy_client
 import pytest
 
 import cdsapi
+from cdsapi import (
+    constraints,
+    dataset,
+    diskspace,
+    grib,
+    pipeline,
+    request,
+    scheduler,
+    transform,
+    transport,
+    workqueue,
+)
 
 
 def test_request():
@@ -47,3 +66,592 @@ def test_instantiation(monkeypatch, key, expected_client, key_from_env):
     assert isinstance(c, cdsapi.Client)
     assert isinstance(c, expected_client)
     assert c.key == key
+
+
+class DummyResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.reason = ""
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(self.status_code)
+
+
+def test_cleaner_coalesces_and_retries():
+    deleted = []
+
+    class Transport(object):
+        def delete(self, url, **kwargs):
+            deleted.append(url)
+            return DummyResponse(500 if len(deleted) == 1 else 200)
+
+    class Client(object):
+        url = "http://cds"
+        transport = Transport()
+        timeout = 1
+
+        def debug(self, *args):
+            pass
+
+        def warning(self, *args):
+            pass
+
+    cleaner = cdsapi.api.Cleaner(Client(), sleep=0)
+    cleaner.add("a")
+    cleaner.add("a")
+    assert cleaner.close(timeout=5)
+    assert cleaner.pending() == 0
+    assert deleted == ["http://cds/tasks/a", "http://cds/tasks/a"]
+
+    # A worker still draining after a timed out close is reused, not doubled
+    cleaner.add("b")
+    assert not cleaner.close(timeout=0) or cleaner._thread is None
+    cleaner.add("c")
+    assert cleaner.close(timeout=5)
+    assert sorted(deleted[2:]) == ["http://cds/tasks/b", "http://cds/tasks/c"]
+    assert [t.name for t in threading.enumerate()].count("cdsapi-cleaner") <= 1
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_compress_transform(parallel):
+    if parallel:
+        stage = transform.ParallelCompressTransform(block_size=1000, workers=2)
+    else:
+        stage = transform.get_transform("gzip")
+    data = os.urandom(100) * 100
+    f = io.BytesIO()
+    for i in range(0, len(data), 64):
+        stage.write(f, data[i : i + 64])
+    stage.finish(f)
+    stage.close()
+    assert gzip.decompress(f.getvalue()) == data
+
+
+def test_dataset_constraints():
+    form = [
+        {
+            "name": "variable",
+            "type": "StringListWidget",
+            "required": True,
+            "details": {"values": ["2t", "msl"]},
+        },
+        {"name": "time", "details": {"groups": [{"values": ["00:00", "12:00"]}]}},
+        {"name": "date", "type": "DateRangeWidget", "details": {}},
+    ]
+    combinations = [
+        {"variable": ["2t"], "time": ["00:00", "12:00"]},
+        {"variable": ["msl"], "time": ["00:00"]},
+    ]
+    c = constraints.DatasetConstraints("era5", form, combinations)
+
+    request = c.validate({"variable": "2t", "time": ["12:00"], "date": "2012-12-01"})
+    assert request["time"] == ["12:00"]
+
+    assert c.errors({"time": "00:00"}) == ["Missing required key 'variable'"]
+    assert c.errors({"variable": "10u"}) == ["Invalid value(s) for 'variable': 10u"]
+    assert c.errors({"variable": "msl", "time": "12:00"})
+    with pytest.raises(Exception):
+        c.validate({"variable": ["2t", "msl"], "time": "12:00"})
+
+
+def test_constraints_cache_concurrent_load(tmp_path):
+    fetched = []
+
+    class Transport(transport.Transport):
+        def request(self, method, url, **kwargs):
+            fetched.append(url)
+            time.sleep(0.05)
+            return transport.Response(200, "OK", {}, content=b"[]")
+
+    class Client(object):
+        url = "http://cds"
+        transport = Transport()
+        timeout = 60
+
+        def robust(self, call):
+            return call
+
+        def debug(self, *args):
+            pass
+
+    cache = constraints.ConstraintsCache(Client(), cache_dir=str(tmp_path))
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get("era5")))
+        for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 8 and all(r is results[0] for r in results)
+    assert len(fetched) == 2
+    assert os.listdir(str(tmp_path)) == ["era5.json"]
+
+
+def test_workqueue_lease(tmp_path):
+    path = str(tmp_path / "queue.db")
+    a = workqueue.WorkQueue(path, worker="a", lease=0.01)
+    b = workqueue.WorkQueue(path, worker="b", lease=600, retry_max=3)
+
+    key = a.submit("era5", {"date": "2012-12-01"}, "out.grib")
+    assert b.submit("era5", {"date": "2012-12-01"}, "out.grib") == key
+
+    assert a.claim()["key"] == key
+    assert a.heartbeat(key, request_id="1234")
+    time.sleep(0.05)
+
+    # The lease of worker a has expired, b takes the job over
+    job = b.claim()
+    assert job["worker"] == "b" and job["request_id"] == "1234"
+    assert not a.complete(key)
+    assert b.claim() is None
+
+    assert b.complete(key)
+    assert a.wait(key) == "out.grib"
+    assert a.stats() == {"completed": 1}
+
+    with pytest.raises(Exception):
+        workqueue.WorkQueue(path, lease=0)
+
+    # A job whose workers keep dying is failed once out of tries
+    lost = a.submit("era5", {"date": "2012-12-02"}, "lost.grib")
+    for i in range(3):
+        assert a.claim()["key"] == lost
+        time.sleep(0.05)
+    assert a.claim() is None
+    assert a.job(lost)["state"] == "failed"
+
+
+def test_workqueue_renew_errors(tmp_path, monkeypatch):
+    queue = workqueue.WorkQueue(str(tmp_path / "queue.db"), lease=0.06)
+    calls = []
+    warnings = []
+
+    def heartbeat(key, **values):
+        calls.append(key)
+        raise sqlite3.OperationalError("database is locked")
+
+    class Client(object):
+        def warning(self, *args):
+            warnings.append(args)
+
+    # Renewal keeps trying until the lease expires, then gives the job up
+    monkeypatch.setattr(queue, "heartbeat", heartbeat)
+    stop, lost = threading.Event(), threading.Event()
+    queue._renew(Client(), "key", stop, lost)
+    assert lost.is_set() and len(calls) >= 2 and len(warnings) == len(calls)
+
+
+def test_workqueue_spilled_download(tmp_path):
+    spill = tmp_path / "spill"
+    spill.mkdir()
+
+    class Result(object):
+        content_length = 4
+
+        def download(self, target, transform=None):
+            path = str(spill / os.path.basename(target))
+            with open(path, "wb") as f:
+                transform.write(f, b"data")
+            return path
+
+    class Client(object):
+        url = "http://cds"
+        validate = False
+
+        def _submit(self, url, request, method):
+            return dict(request_id="1234")
+
+        def _wait(self, reply):
+            return Result()
+
+        def info(self, *args):
+            pass
+
+        warning = error = info
+
+    queue = workqueue.WorkQueue(str(tmp_path / "queue.db"))
+    key = queue.submit("era5", {"date": "2012-12-01"}, str(tmp_path / "out.grib"))
+    queue.run(Client())
+    assert queue.wait(key) == str(spill / "out.grib")
+    assert os.listdir(str(spill)) == ["out.grib"]
+
+
+def test_scheduler_priority():
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    class Client(object):
+        url = "http://cds"
+        validate = False
+
+        def _submit(self, url, request, method):
+            order.append(request["id"])
+            started.set()
+            release.wait(5)
+            return request
+
+        def _wait(self, reply):
+            return reply
+
+    s = scheduler.Scheduler(Client(), max_active=1)
+    first = s.submit("era5", {"id": 0})
+    assert started.wait(5)
+
+    low = s.submit("era5", {"id": 1}, priority=0)
+    high = s.submit("era5", {"id": 2}, priority=10)
+    dropped = s.submit("era5", {"id": 3}, priority=-1)
+    expired = s.submit("era5", {"id": 4}, priority=20, deadline=time.time() - 1)
+    # Cancelled by the caller before its deadline passes
+    cancelled = s.submit("era5", {"id": 5}, priority=30, deadline=time.time() + 0.1)
+    cancelled.future.cancel()
+    time.sleep(0.2)
+    assert s.cancel(dropped)
+
+    release.set()
+    s.close()
+
+    assert order == [0, 2, 1]
+    assert first.result() == {"id": 0} and high.done() and low.done()
+    assert dropped.future.cancelled() and cancelled.future.cancelled()
+    with pytest.raises(Exception):
+        expired.result()
+    stats = s.stats()
+    assert stats["completed"] == 3 and stats["expired"] == 1
+    assert stats["cancelled"] == 2
+
+
+def test_scheduler_preempt():
+    release = threading.Event()
+    order = []
+
+    class Client(object):
+        url = "http://cds"
+        validate = False
+
+        def _submit(self, url, request, method):
+            order.append(request["id"])
+            if request["id"] == 0:
+                release.wait(5)
+            return request
+
+        def _wait(self, reply):
+            return reply
+
+    s = scheduler.Scheduler(Client(), max_active=2)
+    urgent = s.submit("era5", {"id": 0}, priority=10)
+    while not order:
+        time.sleep(0.01)
+    s.preempt(10)
+    bulk = s.submit("era5", {"id": 1}, priority=0)
+
+    # A slot is free, but the bulk job waits for the urgent one
+    time.sleep(0.2)
+    assert order == [0] and not bulk.done()
+
+    release.set()
+    assert urgent.result(5) == {"id": 0} and bulk.result(5) == {"id": 1}
+    s.close()
+
+
+def test_pipeline(tmp_path):
+    class Result(object):
+        def download(self, target):
+            with open(target, "w") as f:
+                f.write(target)
+            return target
+
+    class Client(object):
+        url = "http://cds"
+        validate = False
+
+        def _submit(self, url, request, method):
+            return request
+
+        def _wait(self, reply):
+            return Result()
+
+    def process(target, suffix):
+        with open(target) as f:
+            return f.read() + suffix
+
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+    with pipeline.Pipeline(Client(), executor=executor, max_pending=2) as p:
+        jobs = [
+            p.submit("era5", {"id": i}, str(tmp_path / ("%s.grib" % i)), process, "!")
+            for i in range(5)
+        ]
+    assert [j.result() for j in jobs] == [j.target + "!" for j in jobs]
+    assert set(jobs[0].timings) == set(
+        ["queued", "request", "download", "processing_queued", "processing"]
+    )
+    assert p.stats()["processing"] == 0 and not list(p.as_completed())
+
+    # A processing job that cannot be submitted fails without holding its slot
+    executor.shutdown()
+    with pipeline.Pipeline(Client(), executor=executor, max_pending=1) as p:
+        jobs = [
+            p.submit("era5", {"id": i}, str(tmp_path / ("%s.grib" % i)), process, "!")
+            for i in range(2)
+        ]
+    for job in jobs:
+        with pytest.raises(RuntimeError):
+            job.result()
+
+
+def test_request_ranges():
+    r = request.Request(
+        variable="2t",
+        date=request.DateRange("2012-12-30", "2013-01-02"),
+        time=request.TimeRange("00:00", "18:00", step=6),
+        pressure_level=request.Range(500, 1000, 250),
+    )
+    assert r.toJSON() == {
+        "variable": "2t",
+        "date": ["2012-12-30", "2012-12-31", "2013-01-01", "2013-01-02"],
+        "time": ["00:00", "06:00", "12:00", "18:00"],
+        "pressure_level": ["500", "750", "1000"],
+    }
+    assert r.encode() is r.encode()
+    assert request.encode(r.toJSON()) == r.encode()
+    assert request.request_key("era5", r) == request.request_key("era5", r.toJSON())
+
+    key = r.key()
+    r.update(variable="msl")
+    assert r.key() != key
+
+    assert request.Range(0.1, 0.3, 0.1).toJSON() == ["0.1", "0.2", "0.3"]
+    assert request.Range(1000, 500).toJSON() == []
+    for step in (0, -1):
+        with pytest.raises(Exception):
+            request.Range(1, 10, step)
+        with pytest.raises(Exception):
+            request.DateRange("2012-12-30", "2013-01-02", step)
+
+
+def test_disk_space_spill(tmp_path, monkeypatch):
+    full, spill = tmp_path / "full", tmp_path / "spill"
+    full.mkdir()
+    spill.mkdir()
+
+    space = diskspace.DiskSpace(spill=[str(spill)])
+    monkeypatch.setattr(space, "_device", lambda directory: directory)
+    free = {str(full): 100, str(spill): 1000}
+    evicted = []
+
+    class Usage(object):
+        def __init__(self, directory):
+            self.free = free[directory]
+
+    monkeypatch.setattr(diskspace.shutil, "disk_usage", Usage)
+
+    r = space.reserve(str(full / "a.grib"), 80)
+    assert r.target == str(full / "a.grib")
+    assert space.reserve(str(full / "b.grib"), 80).target == str(spill / "b.grib")
+
+    space.add_evict_hook(lambda directory, size: evicted.append(directory))
+    r.release()
+    r = space.reserve(str(full / "c.grib"), 80)
+    assert r.target == str(full / "c.grib")
+
+    # Bytes on disk are not counted again as reserved
+    monkeypatch.setattr(diskspace.Reservation, "step", 10)
+    free[str(full)] = 50
+    r.update(50)
+    assert space.free(str(full)) == 20
+    r.release()
+    assert space.free(str(full)) == 50
+    free[str(full)] = 100
+
+    with pytest.raises(Exception):
+        space.reserve(str(full / "d.grib"), 2000)
+    assert evicted == [str(full), str(spill)]
+
+
+def test_transport_interface():
+    calls = []
+
+    class Transport(transport.Transport):
+        def request(self, method, url, **kwargs):
+            calls.append((method, url, kwargs.get("headers")))
+
+            def chunks(chunk_size):
+                return iter([b'{"state"', b': "queued"}'])
+
+            return transport.Response(200, "OK", {}, chunks=chunks)
+
+    t = Transport()
+    assert t.get("http://cds/tasks/1").json() == {"state": "queued"}
+    t.stream("http://cds/data", start=0)
+    t.stream("http://cds/data", start=10)
+    t.submit("PUT", "http://cds/tasks", "{}")
+    assert [c[2] for c in calls] == [
+        None,
+        None,
+        {"Range": "bytes=10-"},
+        {"Content-Type": "application/json"},
+    ]
+
+    r = transport.Response(503, "Service Unavailable", {}, content=b"")
+    with pytest.raises(transport.HTTPError):
+        r.raise_for_status()
+
+    with pytest.raises(NotImplementedError):
+        transport.Transport().head("http://cds/data")
+
+
+def grib1_message(param, day):
+    section1 = bytearray(28)
+    section1[0:3] = (28).to_bytes(3, "big")
+    section1[3] = 128
+    section1[8] = param
+    section1[9] = 1
+    section1[12:17] = bytes([12, 12, day, 12, 0])
+    section1[24] = 21
+    length = 8 + len(section1) + 4
+    return b"GRIB" + length.to_bytes(3, "big") + b"\x01" + section1 + b"7777"
+
+
+def grib2_message(number, day):
+    section1 = bytearray(21)
+    section1[0:4] = (21).to_bytes(4, "big")
+    section1[4] = 1
+    section1[12:18] = bytes([7, 220, 12, day, 6, 0])
+    section4 = bytearray(34)
+    section4[0:4] = (34).to_bytes(4, "big")
+    section4[4] = 4
+    section4[9:11] = bytes([0, number])
+    section4[22] = 100
+    section4[24:28] = (850).to_bytes(4, "big")
+    body = bytes(section1 + section4) + b"7777"
+    length = 16 + len(body)
+    return b"GRIB\x00\x00\x00\x02" + length.to_bytes(8, "big") + body
+
+
+def test_grib_splitter(tmp_path):
+    messages = [
+        grib1_message(167, 1),
+        grib1_message(151, 1),
+        grib1_message(167, 2),
+        grib2_message(0, 1),
+    ]
+    data = b"".join(messages)
+    template = str(tmp_path / "{param}" / "{date}-{levelType}-{level}.grib")
+
+    splitter = grib.GribSplitter(template, max_open=1)
+    for i in range(0, len(data), 7):
+        splitter.write(None, data[i : i + 7])
+    splitter.finish(None)
+    splitter.close()
+
+    assert splitter.count == 4
+    assert list(splitter.paths) == [
+        str(tmp_path / "128.167" / "20121201-1-0.grib"),
+        str(tmp_path / "128.151" / "20121201-1-0.grib"),
+        str(tmp_path / "128.167" / "20121202-1-0.grib"),
+        str(tmp_path / "0.0.0" / "20121201-100-850.grib"),
+    ]
+    for path, message in zip(splitter.paths, messages):
+        with open(path, "rb") as f:
+            assert f.read() == message
+
+    truncated = grib.GribSplitter(template)
+    truncated.write(None, data[:-1])
+    with pytest.raises(Exception):
+        truncated.finish(None)
+    truncated.close()
+
+    class Space(object):
+        def reserve(self, target, size):
+            raise Exception("No space reserved for an unused target")
+
+    class Transport(transport.Transport):
+        def request(self, method, url, **kwargs):
+            return transport.Response(200, "OK", {}, chunks=lambda size: [data])
+
+    # Downloading through the splitter returns the files it wrote
+    result = cdsapi.api.Result.__new__(cdsapi.api.Result)
+    result.__dict__.update(
+        reply=dict(location="http://cds/data.grib", content_length=len(data)),
+        _url="http://cds",
+        _deleted=True,
+        transport=Transport(),
+        robust=lambda call: call,
+        disk_space=Space(),
+        retry_max=1,
+        timeout=60,
+        progress=False,
+        info=lambda *args: None,
+    )
+    splitter = grib.GribSplitter(str(tmp_path / "split" / "{count}.grib"))
+    paths = result.download(str(tmp_path / "unused.grib"), transform=splitter)
+    assert paths == [str(tmp_path / "split" / ("%s.grib" % i)) for i in range(4)]
+    assert result.target == paths
+    with pytest.raises(Exception):
+        result.download(str(tmp_path / "unused.grib"), transform=splitter)
+
+
+def test_retrieve_dataset_cache(tmp_path, monkeypatch):
+    retrieved = []
+    opened = []
+    closed = []
+
+    class Result(object):
+        location = "http://cds/cache/data.nc"
+
+        def download(self, target):
+            with open(target, "w") as f:
+                f.write("data")
+            return target
+
+    class Client(object):
+        def retrieve(self, name, request):
+            retrieved.append(request)
+            return Result()
+
+    class Dataset(object):
+        def close(self):
+            closed.append(self)
+
+    class xarray(object):
+        @staticmethod
+        def open_dataset(path, chunks=None, **kwargs):
+            opened.append(path)
+            return Dataset()
+
+    monkeypatch.setitem(sys.modules, "xarray", xarray)
+
+    request = {"variable": "2t"}
+    ds = dataset.retrieve_dataset(Client(), "era5", request, str(tmp_path))
+    assert dataset.retrieve_dataset(Client(), "era5", request, str(tmp_path)) is ds
+    assert retrieved == [request]
+    assert os.listdir(str(tmp_path)) == [os.path.basename(opened[0])]
+    assert opened[0].endswith(".nc")
+
+    dataset.retrieve_dataset(Client(), "era5", request, str(tmp_path), chunks={})
+    assert len(opened) == 2 and retrieved == [request]
+
+    # Only the last opened datasets are kept
+    monkeypatch.setattr(dataset, "MAX_OPENED", 1)
+    dataset.retrieve_dataset(Client(), "era5", request, str(tmp_path), chunks=1)
+    dataset.retrieve_dataset(Client(), "era5", request, str(tmp_path))
+    assert len(opened) == 4 and len(dataset._OPENED) == 1
+    assert len(closed) == 3 and ds in closed
+
+    # A spilled download is copied into the cache directory
+    spill = tmp_path / "spill"
+    spill.mkdir()
+
+    class SpilledResult(Result):
+        def download(self, target):
+            return super().download(str(spill / os.path.basename(target)))
+
+    cache_dir = tmp_path / "cache"
+    result = SpilledResult()
+    path = dataset.download(result, str(cache_dir), "key")
+    assert path == str(cache_dir / "key.nc") and result.target == path
+    assert os.listdir(str(cache_dir)) == ["key.nc"] and not os.listdir(str(spill))